@@ -1,5 +1,26 @@
+import cv2
+import numpy as np
 import pytest
-from video_danmaku.core import VideoProcessor
+from pathlib import Path
+from PIL import ImageFont
+from video_danmaku.core import (
+    DanmakuManager,
+    FFmpegWriter,
+    PyAVReader,
+    VideoProcessor,
+    _blend_roi_numpy,
+    _blit_sprite,
+    _render_chunk,
+    _split_frames,
+    _with_filters,
+)
+
+
+@pytest.fixture
+def default_font(monkeypatch):
+    """用Pillow内置字体代替msyh.ttc，测试不依赖系统字体"""
+    font = ImageFont.load_default(25)
+    monkeypatch.setattr(ImageFont, "truetype", lambda *args, **kwargs: font)
 
 
 def test_video_processor():
@@ -7,3 +28,405 @@ def test_video_processor():
         "tests/assets/1.mp4", "tests/assets/output.mp4", "tests/assets/dm.json"
     )
     processor.process()
+
+
+def _write_clip(path, n_frames=60, size=(160, 64), fps=30):
+    """用OpenCV写入一段纯黑的短视频"""
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+    for _ in range(n_frames):
+        writer.write(np.zeros((size[1], size[0], 3), dtype=np.uint8))
+    writer.release()
+
+
+def _read_clip(path):
+    cap = cv2.VideoCapture(str(path))
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def _danmaku_box(manager, frame):
+    """取出帧中第一条活跃弹幕所在的区域"""
+    danmaku = manager.active_danmakus[0]
+    x = max(int(round(manager.active_x[0])), 0)
+    return frame[danmaku.y : danmaku.y + 25, x : x + int(danmaku.width)]
+
+
+@pytest.fixture
+def clip(tmp_path):
+    video = tmp_path / "input.mp4"
+    _write_clip(video)
+    danmaku_file = tmp_path / "dm.json"
+    danmaku_file.write_text(
+        '[{"text": "弹幕", "time_stamp": 0, "color": [255, 255, 255], "alpha": 255}]',
+        encoding="utf-8",
+    )
+    return video, danmaku_file
+
+
+def test_process_renders_every_frame(default_font, clip, tmp_path):
+    video, danmaku_file = clip
+    output = tmp_path / "output.mp4"
+    processor = VideoProcessor(str(video), str(output), str(danmaku_file))
+    processor.process()
+
+    frames = _read_clip(output)
+    assert len(frames) == 60
+    # 输入为纯黑画面，弹幕所在区域应被绘制为白色
+    assert _danmaku_box(processor.manager, frames[-1]).max() > 128
+    assert frames[-1][-10:].max() < 64
+
+
+@pytest.mark.parametrize("use_av", [True, False])
+def test_run_pipeline_sub_range(default_font, monkeypatch, tmp_path, use_av):
+    from video_danmaku import core
+
+    video = tmp_path / "indexed.ts"
+    _write_indexed_ts(video, height=96)
+    if not use_av:
+        monkeypatch.setattr(core, "av", None)  # 使用OpenCV解码
+    danmaku_file = tmp_path / "dm.json"
+    danmaku_file.write_text(
+        '[{"text": "弹幕", "time_stamp": 0, "color": [255, 255, 255], "alpha": 255}]',
+        encoding="utf-8",
+    )
+    output = tmp_path / "output.mp4"
+    processor = VideoProcessor(str(video), str(output), str(danmaku_file))
+    try:
+        processor._initialize()
+        processor._run_pipeline(20, 40, show_progress=False)
+    finally:
+        processor.cleanup()
+
+    frames = _read_clip(output)
+    assert [_frame_index(frame) for frame in frames] == list(range(20, 40))
+    # 区间之前的帧只推进弹幕状态，结束时与从头播放到第39帧一致
+    reference = processor._create_manager(128, 96, fps=25)
+    for frame_idx in range(40):
+        reference.advance(frame_idx / 25)
+    assert np.allclose(processor.manager.active_x, reference.active_x)
+
+
+def test_parse_ass_file(tmp_path):
+    danmaku_file = tmp_path / "dm.ass"
+    danmaku_file.write_text(
+        "[Events]\n"
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n"
+        "Dialogue: 0,0:00:01.50,0:00:05.00,Default,,0,0,0,,弹幕, 文本\n"
+        "Dialogue: 0,0:00:02.00,0:00:03.00,Default\n"
+        "Dialogue: 0,1:02:03.04,1:02:08.00,Default,,0,0,0,,第二条\n",
+        encoding="utf-8",
+    )
+    processor = VideoProcessor("input.mp4", "output.mp4", str(danmaku_file))
+    assert processor.danmaku_list == [
+        ("弹幕, 文本", 1.5, (255, 255, 255), 255),
+        ("第二条", 3723.04, (255, 255, 255), 255),
+    ]
+
+
+def _write_indexed_ts(path, n_frames=100, gop=50, height=16, format="mpegts"):
+    """写入每帧用8个黑白色块编码帧序号的视频，默认为MPEG-TS"""
+    av = pytest.importorskip("av")
+    container = av.open(str(path), "w", format=format)
+    stream = container.add_stream("libx264", rate=25)
+    stream.width, stream.height, stream.pix_fmt = 128, height, "yuv420p"
+    stream.options = {"g": str(gop), "keyint_min": str(gop), "sc_threshold": "0"}
+    for i in range(n_frames):
+        image = np.zeros((height, 128, 3), dtype=np.uint8)
+        for bit in range(8):
+            if i >> bit & 1:
+                image[:, bit * 16 : (bit + 1) * 16] = 255
+        frame = av.VideoFrame.from_ndarray(image, format="bgr24")
+        for packet in stream.encode(frame):
+            container.mux(packet)
+    for packet in stream.encode():
+        container.mux(packet)
+    container.close()
+
+
+def _frame_index(frame):
+    # 只看底部几行，避开上方轨道中的弹幕
+    return sum(
+        1 << bit
+        for bit in range(8)
+        if frame[-8:, bit * 16 + 4 : (bit + 1) * 16 - 4].mean() > 127
+    )
+
+
+def test_pyav_reader_seek(tmp_path):
+    video = tmp_path / "indexed.ts"
+    _write_indexed_ts(video)
+    for target in (0, 10, 37, 50, 60, 99):
+        reader = PyAVReader(str(video))
+        try:
+            reader.set(cv2.CAP_PROP_POS_FRAMES, target)
+            ret, frame = reader.read()
+            assert ret
+            assert _frame_index(frame) == target
+        finally:
+            reader.release()
+
+
+@pytest.mark.parametrize("target", [0, 50])
+def test_pyav_reader_seek_to_keyframe(tmp_path, monkeypatch, target):
+    video = tmp_path / "indexed.mp4"
+    _write_indexed_ts(video, format="mp4")
+    reader = PyAVReader(str(video))
+    reopened = []
+    open_video = reader._open
+    monkeypatch.setattr(reader, "_open", lambda: reopened.append(True) or open_video())
+    try:
+        reader.set(cv2.CAP_PROP_POS_FRAMES, target)
+        ret, frame = reader.read()
+        assert _frame_index(frame) == target
+        # 落点恰好是目标关键帧时直接使用，无需回退或重新打开视频
+        assert not reopened
+    finally:
+        reader.release()
+
+
+def test_split_frames():
+    assert _split_frames(10, 3) == [(0, 3), (3, 6), (6, 10)]
+    assert _split_frames(2, 4) == [(0, 1), (1, 2)]
+    assert _split_frames(0, 4) == []
+
+
+def test_with_filters():
+    assert _with_filters([], ("-preset", "p5")) == ["-preset", "p5"]
+    assert _with_filters(["pad"], ("-pix_fmt", "yuv420p")) == [
+        "-vf",
+        "pad",
+        "-pix_fmt",
+        "yuv420p",
+    ]
+    # VAAPI的hwupload必须接在其余滤镜之后
+    assert _with_filters(["subtitles", "pad"], ("-vf", "format=nv12,hwupload")) == [
+        "-vf",
+        "subtitles,pad,format=nv12,hwupload",
+    ]
+
+
+def _require_encoder():
+    from video_danmaku import core
+
+    encoder = core._select_h264_encoder()
+    if encoder is None:
+        pytest.skip("ffmpeg is not available")
+    return encoder
+
+
+def test_ffmpeg_writer_pads_odd_size(tmp_path):
+    encoder = _require_encoder()
+    output = tmp_path / "odd.mp4"
+    writer = FFmpegWriter(str(output), 25, (33, 17), encoder)
+    for _ in range(5):
+        writer.write(np.full((17, 33, 3), 200, dtype=np.uint8))
+    writer.release()
+
+    frames = _read_clip(output)
+    assert len(frames) == 5
+    assert frames[0].shape == (18, 34, 3)
+
+
+def test_render_chunk_uses_given_encoder(default_font, clip, tmp_path, monkeypatch):
+    from video_danmaku import core
+
+    encoder = _require_encoder()
+    # 子进程不应再次探测编码器
+    monkeypatch.setattr(core, "_select_h264_encoder", None)
+    video, danmaku_file = clip
+    output = tmp_path / "chunk.mp4"
+    _render_chunk(str(video), str(output), str(danmaku_file), 10, 30, False, encoder)
+    assert len(_read_clip(output)) == 20
+
+
+def test_libass_gets_fonts_dir(default_font, clip, tmp_path, monkeypatch):
+    from video_danmaku import core
+
+    video, danmaku_file = clip
+    # 默认字体msyh.ttc按相对于当前目录的路径载入
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "msyh.ttc").write_bytes(b"font")
+    monkeypatch.setattr(
+        core, "_select_h264_encoder", lambda: ("libx264", (), ("-pix_fmt", "yuv420p"))
+    )
+    calls = []
+
+    def fake_run(args, cwd, check):
+        calls.append((args, sorted(p.name for p in Path(cwd, "fonts").iterdir())))
+
+    monkeypatch.setattr(core.subprocess, "run", fake_run)
+    VideoProcessor(str(video), "output.mp4", str(danmaku_file)).process_libass()
+
+    ((args, fonts),) = calls
+    assert args[args.index("-vf") + 1].startswith(
+        "subtitles=danmaku.ass:fontsdir=fonts,"
+    )
+    assert fonts == ["msyh.ttc"]
+
+
+def test_to_ass_escapes_text_and_keeps_render_state(default_font):
+    manager = DanmakuManager(320, 240)
+    manager.add_danmaku("a{\\b1}b\\N", 0.0)
+    manager.add_danmaku("second", 0.0)
+    frame = np.zeros((240, 320, 3), dtype=np.uint8)
+    manager.render_frame(frame, 0.0)
+    state = [(d.y, d.speed) for d in manager.active_danmakus]
+    active_speed = manager.active_speed.copy()
+
+    ass = manager.to_ass()
+
+    assert "a\\{\\\u200bb1\\}b\\\u200bN" in ass
+    assert [(d.y, d.speed) for d in manager.active_danmakus] == state
+    assert np.array_equal(manager.active_speed, active_speed)
+
+
+def _track_schedule():
+    rng = np.random.default_rng(0)
+    times = np.sort(rng.uniform(0, 30, 20))
+    lengths = rng.integers(1, 20, 20)
+    return [("弹" * int(n), float(t)) for n, t in zip(lengths, times)]
+
+
+def test_tracks_do_not_overlap_and_are_deterministic(default_font):
+    fps = 30
+    placements = []
+    for _ in range(2):
+        manager = DanmakuManager(320, 240, fps=fps)
+        for text, time_stamp in _track_schedule():
+            manager.add_danmaku(text, time_stamp)
+        for frame_idx in range(40 * fps):
+            manager.advance(frame_idx / fps)
+            spans = {}
+            for danmaku, x in zip(manager.active_danmakus, manager.active_x):
+                spans.setdefault(danmaku.y, []).append((x, x + danmaku.width))
+            for track_spans in spans.values():
+                track_spans.sort()
+                for (_, prev_end), (next_start, _) in zip(track_spans, track_spans[1:]):
+                    assert prev_end <= next_start
+        placements.append([(d.text, d.time_stamp, d.y) for d in manager.danmakus])
+    assert placements[0] == placements[1]
+    assert len({y for _, _, y in placements[0]}) > 1
+
+
+def _random_sprite(rng, height, width):
+    alpha = rng.integers(0, 256, (height, width), dtype=np.uint8)
+    alpha[: height // 2, : width // 2] = 0  # 完全透明的区域
+    color = rng.integers(0, 256, 3, dtype=np.uint16)
+    return alpha, color
+
+
+def test_numba_blend_matches_numpy():
+    pytest.importorskip("numba")
+    from video_danmaku import core
+
+    assert core._blend_roi is not _blend_roi_numpy
+    rng = np.random.default_rng(0)
+    alpha, color = _random_sprite(rng, 30, 40)
+    frame = rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)
+    expected = frame.copy()
+    # 非连续的裁剪区域
+    _blend_roi_numpy(expected[5:35, 10:50], alpha, color)
+    core._blend_roi(frame[5:35, 10:50], alpha, color)
+    assert np.array_equal(frame, expected)
+
+
+@pytest.mark.parametrize("x0, y0", [(-15, -10), (50, 30), (-100, 0), (64, 0)])
+def test_blit_sprite_clips_to_frame(x0, y0):
+    rng = np.random.default_rng(1)
+    alpha, color = _random_sprite(rng, 30, 40)
+    frame = rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)
+    # 在四周留足边距的大画布上完整混合，再裁剪回原画面作为期望结果
+    pad = 100
+    canvas = np.zeros((48 + 2 * pad, 64 + 2 * pad, 3), dtype=np.uint8)
+    canvas[pad:-pad, pad:-pad] = frame
+    _blend_roi_numpy(
+        canvas[y0 + pad : y0 + pad + 30, x0 + pad : x0 + pad + 40], alpha, color
+    )
+    _blit_sprite(frame, alpha, color, x0, y0)
+    assert np.array_equal(frame, canvas[pad:-pad, pad:-pad])
+
+
+def test_add_danmaku_mid_playback(default_font):
+    manager = DanmakuManager(320, 240)
+    manager.add_danmaku("first", 1.0)
+    manager.add_danmaku("last", 5.0)
+    manager.advance(2.0)
+    assert [d.text for d in manager.active_danmakus] == ["first"]
+
+    # 播放中途追加，其中一条的时间早于当前时间
+    manager.add_danmaku("middle", 3.0)
+    manager.add_danmaku("late", 0.5)
+    manager.advance(2.1)
+    assert [d.text for d in manager.active_danmakus] == ["first", "late"]
+    assert [d.text for d in manager.danmakus] == ["first", "late", "middle", "last"]
+
+    manager.advance(5.0)
+    assert [d.text for d in manager.active_danmakus] == [
+        "first",
+        "late",
+        "middle",
+        "last",
+    ]
+
+
+def test_render_uses_bgr_channel_order(default_font):
+    manager = DanmakuManager(320, 240)
+    manager.add_danmaku("弹幕测试", 0.0, color=(255, 0, 0))
+    frame = manager.render_frame(np.zeros((240, 320, 3), dtype=np.uint8), 5.0)
+    # 红色只应出现在BGR的第2个通道
+    assert frame[..., 2].max() == 255
+    assert not frame[..., :2].any()
+
+
+def test_sprites_are_released(default_font, monkeypatch):
+    from video_danmaku import core
+
+    monkeypatch.setattr(core, "_SPRITE_CACHE_SIZE", 4)
+    manager = DanmakuManager(320, 240)
+    for i in range(10):
+        manager.add_danmaku(f"弹幕{i}", i * 0.1)
+    frame = np.zeros((240, 320, 3), dtype=np.uint8)
+    for frame_idx in range(40):
+        manager.render_frame(frame, frame_idx / 30)
+    assert all(d.sprite_alpha is not None for d in manager.active_danmakus)
+    assert manager._sprite_cache.cache_info().currsize <= 4
+    assert manager._mask_cache.cache_info().currsize <= 4
+
+    # 全部移出画面后，弹幕不再持有精灵
+    for frame_idx in range(40, 20 * 30):
+        manager.advance(frame_idx / 30)
+    assert not manager.active_danmakus
+    assert all(d.sprite_alpha is None for d in manager.danmakus)
+
+
+def test_cuda_render_matches_cpu(default_font):
+    pytest.importorskip("cupy")
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    managers = [DanmakuManager(320, 240), DanmakuManager(320, 240, use_cuda=True)]
+    for manager in managers:
+        manager.add_danmaku("弹幕测试", 0.0, color=(255, 128, 0), alpha=200)
+        manager.add_danmaku("第二条", 0.5)
+    for frame_idx in range(60):
+        cpu, gpu = (
+            manager.render_frame(background.copy(), frame_idx / 30)
+            for manager in managers
+        )
+        assert np.array_equal(cpu, gpu)
+
+
+def test_cuda_without_cupy_fails_before_writing(monkeypatch, clip, tmp_path):
+    from video_danmaku import core
+
+    monkeypatch.setattr(core, "cp", None)
+    video, danmaku_file = clip
+    output = tmp_path / "output.mp4"
+    with pytest.raises(RuntimeError, match="CuPy"):
+        VideoProcessor(str(video), str(output), str(danmaku_file), use_cuda=True)
+    assert not output.exists()
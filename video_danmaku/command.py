@@ -24,6 +24,23 @@ def main(
         dir_okay=False,
         resolve_path=True,
     ),
+    workers: int = typer.Option(
+        1,
+        "--workers",
+        "-w",
+        min=1,
+        help="Number of worker processes; more than 1 renders chunks in parallel (requires ffmpeg)",
+    ),
+    libass: bool = typer.Option(
+        False,
+        "--libass",
+        help="Burn in danmaku with ffmpeg's libass subtitles filter instead of rendering in Python (requires ffmpeg)",
+    ),
+    cuda: bool = typer.Option(
+        False,
+        "--cuda",
+        help="Composite danmaku on the GPU (requires CuPy)",
+    ),
 ):
     """
     Process video with danmaku overlay.
@@ -33,14 +50,22 @@ def main(
         if not str(danmaku_file).lower().endswith((".ass", ".ssa", ".json")):
             typer.echo("Error: Unsupported danmaku file format", err=True)
             raise typer.Exit(1)
+        if cuda and libass:
+            typer.echo("Error: --cuda cannot be combined with --libass", err=True)
+            raise typer.Exit(1)
 
         typer.echo(f"🎬 Processing video: {input_video}")
         typer.echo(f"📝 Using danmaku file: {danmaku_file}")
 
         processor = VideoProcessor(
-            str(input_video), str(output_video), str(danmaku_file)
+            str(input_video), str(output_video), str(danmaku_file), use_cuda=cuda
         )
-        processor.process()
+        if libass:
+            processor.process_libass()
+        elif workers > 1:
+            processor.process_parallel(workers)
+        else:
+            processor.process()
         typer.echo(f"✅ Output saved to: {output_video}")
 
     except Exception as e:
@@ -1,14 +1,124 @@
 # -*- coding:utf-8 -*-
 import cv2
 import json
-import re
+import multiprocessing
 import numpy as np
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
 import typer
 from PIL import Image, ImageDraw, ImageFont
 from typing import List, Tuple, Dict, Optional
-import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import lru_cache, partial
+from itertools import chain
 from pathlib import Path
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba 为可选依赖，未安装时使用 NumPy 实现
+    njit = None
+
+try:
+    import av
+except ImportError:  # PyAV 为可选依赖，未安装时使用 OpenCV 解码
+    av = None
+
+try:
+    import cupy as cp
+except ImportError:  # CuPy 为可选依赖，仅在使用GPU渲染时需要
+    cp = None
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库 json
+    orjson = None
+
+
+def _queue_put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """向队列放入数据，流水线中止时返回False"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _queue_get(q: queue.Queue, stop: threading.Event):
+    """从队列取出数据，流水线中止时返回None"""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+
+def _blend_roi_numpy(roi: np.ndarray, alpha: np.ndarray, color: np.ndarray):
+    """按uint8遮罩alpha将BGR颜色color混合到同尺寸的BGR区域(NumPy实现)"""
+    # 定点整数运算: (a * fg + (255 - a) * bg + 127) // 255
+    a = alpha[..., None].astype(np.uint16)
+    roi[...] = (a * color + (255 - a) * roi + 127) // 255
+
+
+if njit is not None:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _blend_roi(roi: np.ndarray, alpha: np.ndarray, color: np.ndarray):
+        """按uint8遮罩alpha将BGR颜色color混合到同尺寸的BGR区域(Numba实现，逐行并行)"""
+        for i in prange(roi.shape[0]):
+            for j in range(roi.shape[1]):
+                a = np.int32(alpha[i, j])
+                if a == 0:
+                    continue
+                for c in range(3):
+                    roi[i, j, c] = (
+                        a * np.int32(color[c])
+                        + (255 - a) * np.int32(roi[i, j, c])
+                        + 127
+                    ) // 255
+
+else:
+    _blend_roi = _blend_roi_numpy
+
+
+if cp is not None:
+    _cuda_blend_kernel = cp.ElementwiseKernel(
+        "uint8 alpha, uint16 color",
+        "uint8 dst",
+        "dst = (alpha * color + (255 - alpha) * dst + 127) / 255",
+        "danmaku_blend",
+    )
+
+    def _blend_roi_cuda(roi, alpha, color):
+        """按uint8遮罩alpha将BGR颜色color混合到同尺寸的BGR区域(CuPy实现，单个融合的CUDA核函数)"""
+        _cuda_blend_kernel(alpha[..., None], color, roi)
+
+
+def _blit_sprite(
+    dst: np.ndarray,
+    alpha: np.ndarray,
+    color: np.ndarray,
+    x0: int,
+    y0: int,
+    blend=_blend_roi,
+):
+    """将弹幕遮罩以color颜色贴到BGR帧的(x0, y0)处，超出画面的部分被裁剪"""
+    height, width = dst.shape[:2]
+    x1 = min(x0 + alpha.shape[1], width)
+    y1 = min(y0 + alpha.shape[0], height)
+    sx, sy = max(-x0, 0), max(-y0, 0)
+    x0, y0 = max(x0, 0), max(y0, 0)
+    if x0 >= x1 or y0 >= y1:
+        return
+    blend(dst[y0:y1, x0:x1], alpha[sy : sy + y1 - y0, sx : sx + x1 - x0], color)
+
 
 class Danmaku:
     """单条弹幕类"""
@@ -26,23 +136,52 @@ class Danmaku:
         self.font_size = font_size
         self.color = color
         self.alpha = alpha
-        self.x = None  # 横坐标
         self.y = None  # 纵坐标
         self.width = None  # 文字宽度
         self.speed = None  # 移动速度
+        self.sprite_alpha = None  # 预渲染的uint8文字遮罩，已乘入透明度
+        self.sprite_color = None  # BGR顺序的文字颜色
+
+
+# 文字遮罩和精灵缓存各自最多保留的条目数
+_SPRITE_CACHE_SIZE = 1024
 
 
 class DanmakuManager:
     """弹幕管理器"""
 
     def __init__(
-        self, video_width: int, video_height: int, font_path: str = "msyh.ttc"
+        self,
+        video_width: int,
+        video_height: int,
+        font_path: str = "msyh.ttc",
+        fps: float = 30,
+        use_cuda: bool = False,
     ):
+        if use_cuda and cp is None:
+            raise RuntimeError("CuPy is required to render danmaku on the GPU")
         self.video_width = video_width
         self.video_height = video_height
+        self.fps = fps
+        # 使用GPU时精灵常驻显存，每帧整帧只上传、下载各一次
+        self.use_cuda = use_cuda
+        self._blend = _blend_roi_cuda if use_cuda else _blend_roi
+        self._gpu_frame = None  # 复用的显存帧缓冲，避免每帧重新分配
         self.font_path = font_path
-        self.danmakus: List[Danmaku] = []
+        self.font = ImageFont.truetype(font_path, size=25)
+        # 重复的弹幕文本很常见，按文本缓存宽度和文字遮罩，按(文本, 透明度)缓存精灵；
+        # 遮罩和精灵只保留最近使用的一部分，避免长视频中内存(或显存)持续增长
+        self._width_cache: Dict[str, float] = {}
+        self._mask_cache = lru_cache(maxsize=_SPRITE_CACHE_SIZE)(self._render_mask)
+        self._sprite_cache = lru_cache(maxsize=_SPRITE_CACHE_SIZE)(self._render_sprite)
+        self.danmakus: List[Danmaku] = []  # 尚未出现的部分按出现时间排序
+        self._next_idx = 0  # 下一条待出现弹幕的下标
+        self._spawn_times: Optional[np.ndarray] = None  # 与danmakus对应的出现时间
         self.active_danmakus: List[Danmaku] = []  # 当前帧活跃的弹幕
+        # 活跃弹幕的横坐标、速度、宽度，与active_danmakus一一对应
+        self.active_x = np.empty(0, dtype=np.float64)
+        self.active_speed = np.empty(0, dtype=np.float64)
+        self.active_w = np.empty(0, dtype=np.float64)
         self.track_heights = []  # 弹幕轨道高度列表
         self._init_tracks()
 
@@ -51,6 +190,10 @@ class DanmakuManager:
         track_height = 30  # 每个轨道的高度
         num_tracks = self.video_height // track_height
         self.track_heights = [i * track_height for i in range(num_tracks)]
+        self.track_gap = 20  # 同一轨道上相邻弹幕的最小间距
+        # 每个轨道上最后一条弹幕完全进入画面(含间距)的时间，以及完全离开画面的时间
+        self._track_enter_at = [float("-inf")] * num_tracks
+        self._track_leave_at = [float("-inf")] * num_tracks
 
     def add_danmaku(
         self,
@@ -61,77 +204,452 @@ class DanmakuManager:
     ):
         """添加一条弹幕"""
         danmaku = Danmaku(text, time_stamp, color=color, alpha=alpha)
+        width = self._width_cache.get(text)
+        if width is None:
+            width = self._width_cache[text] = self.font.getlength(text)
+        danmaku.width = width
         self.danmakus.append(danmaku)
+        self._spawn_times = None  # 待出现的弹幕需要重新排序
 
     def render_frame(self, frame: np.ndarray, current_time: float) -> np.ndarray:
         """渲染当前帧的弹幕"""
-        # 转换为PIL图像以便绘制文字
-        pil_image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-        draw = ImageDraw.Draw(pil_image)
-        font = ImageFont.truetype(self.font_path, size=25)
+        self.advance(current_time)
+        if not self.active_danmakus:
+            # 没有活跃弹幕时原样返回
+            return frame
+
+        # 绘制所有活跃弹幕
+        if self.use_cuda:
+            if self._gpu_frame is None or self._gpu_frame.shape != frame.shape:
+                self._gpu_frame = cp.empty(frame.shape, dtype=cp.uint8)
+            self._gpu_frame.set(frame)
+            target = self._gpu_frame
+        else:
+            target = frame
+        xs = np.rint(self.active_x).astype(int)
+        for i, danmaku in enumerate(self.active_danmakus):
+            if danmaku.sprite_alpha is None:
+                self._rasterize(danmaku)
+            _blit_sprite(
+                target,
+                danmaku.sprite_alpha,
+                danmaku.sprite_color,
+                xs[i],
+                danmaku.y,
+                blend=self._blend,
+            )
 
-        # 创建透明图层
-        overlay = Image.new("RGBA", pil_image.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(overlay)
+        if self.use_cuda:
+            target.get(out=frame)
+        return frame
 
+    def advance(self, current_time: float):
+        """推进到当前帧的弹幕状态(出现、移动、消失)，不进行绘制"""
         # 更新活跃弹幕
         self._update_active_danmakus(current_time)
 
-        # 绘制所有活跃弹幕
-        for danmaku in self.active_danmakus:
-            if danmaku.x is None:
-                # 初始化弹幕位置
-                danmaku.x = self.video_width
-                danmaku.y = self._get_available_track()
-                text_width = draw.textlength(danmaku.text, font=font)
-                danmaku.width = text_width
-                danmaku.speed = (
-                    self.video_width + text_width
-                ) / 8  # 降低速度，8秒穿过屏幕
-
-            # 更新位置
-            danmaku.x -= danmaku.speed / 30  # 假设30fps
-
-            # 使用RGBA颜色
-            color_with_alpha = (*danmaku.color, danmaku.alpha)
-            draw.text(
-                (danmaku.x, danmaku.y), danmaku.text, font=font, fill=color_with_alpha
-            )
+        # 所有活跃弹幕一次性更新位置
+        self.active_x -= self.active_speed / self.fps
+
+    def _rasterize(self, danmaku: Danmaku):
+        """为弹幕取得预渲染的精灵，之后每帧只需贴图；相同文本和透明度的弹幕共用一份遮罩"""
+        color = np.array(danmaku.color[::-1], dtype=np.uint16)
+        danmaku.sprite_alpha = self._sprite_cache(danmaku.text, danmaku.alpha)
+        danmaku.sprite_color = cp.asarray(color) if self.use_cuda else color
 
-        # 合并图层
-        pil_image = Image.alpha_composite(pil_image.convert("RGBA"), overlay)
+    def _render_sprite(self, text: str, alpha: int):
+        """由文字遮罩生成乘入透明度的uint8遮罩，每像素只占1字节，颜色在混合时再乘入"""
+        mask = self._mask_cache(text)
+        if alpha != 255:
+            mask = ((mask.astype(np.uint16) * alpha + 127) // 255).astype(np.uint8)
+        return cp.asarray(mask) if self.use_cuda else mask
 
-        # 转换回OpenCV格式
-        return cv2.cvtColor(np.array(pil_image.convert("RGB")), cv2.COLOR_RGB2BGR)
+    def _render_mask(self, text: str) -> np.ndarray:
+        """用FreeType将文字绘制为uint8遮罩，与颜色无关，同一文本只绘制一次"""
+        _, _, right, bottom = self.font.getbbox(text)
+        mask = Image.new("L", (max(right, 1), max(bottom, 1)), 0)
+        ImageDraw.Draw(mask).text((0, 0), text, font=self.font, fill=255)
+        return np.asarray(mask)
 
     def _update_active_danmakus(self, current_time: float):
         """更新活跃弹幕列表"""
         # 移除已经移出屏幕的弹幕
-        self.active_danmakus = [d for d in self.active_danmakus if d.x > -d.width]
+        visible = self.active_x > -self.active_w
+        if not visible.all():
+            # 离开画面的弹幕不再绘制，释放其对精灵的引用
+            for d, keep in zip(self.active_danmakus, visible):
+                if not keep:
+                    d.sprite_alpha = d.sprite_color = None
+            self.active_danmakus = [
+                d for d, keep in zip(self.active_danmakus, visible) if keep
+            ]
+            self.active_x = self.active_x[visible]
+            self.active_speed = self.active_speed[visible]
+            self.active_w = self.active_w[visible]
 
-        # 添加新的弹幕
-        new_danmakus = [
-            d
-            for d in self.danmakus
-            if d.time_stamp <= current_time and d not in self.active_danmakus
+        # 添加新的弹幕，待出现的弹幕已按时间排序，二分查找本帧应出现的范围
+        self._sort_pending()
+        end = self._next_idx + int(
+            np.searchsorted(
+                self._spawn_times[self._next_idx :], current_time, side="right"
+            )
+        )
+        new_danmakus = self.danmakus[self._next_idx : end]
+        for danmaku in new_danmakus:
+            self._place(danmaku)
+        self._next_idx = end
+
+        if new_danmakus:
+            self.active_danmakus.extend(new_danmakus)
+            self.active_x = np.concatenate(
+                [self.active_x, np.full(len(new_danmakus), float(self.video_width))]
+            )
+            self.active_speed = np.concatenate(
+                [self.active_speed, [d.speed for d in new_danmakus]]
+            )
+            self.active_w = np.concatenate(
+                [self.active_w, [d.width for d in new_danmakus]]
+            )
+
+    def _sort_pending(self):
+        """添加弹幕后，将尚未出现的弹幕按时间稳定排序并重建出现时间数组"""
+        if self._spawn_times is not None:
+            return
+        self.danmakus[self._next_idx :] = sorted(
+            self.danmakus[self._next_idx :], key=lambda d: d.time_stamp
+        )
+        self._spawn_times = np.array(
+            [d.time_stamp for d in self.danmakus], dtype=np.float64
+        )
+
+    def _place(self, danmaku: Danmaku):
+        """初始化弹幕的速度和所在轨道"""
+        danmaku.speed = self._speed(danmaku)
+        danmaku.y = self._get_available_track(danmaku)
+
+    def _speed(self, danmaku: Danmaku) -> float:
+        """弹幕的移动速度(像素/秒)"""
+        return (self.video_width + danmaku.width) / 8  # 降低速度，8秒穿过屏幕
+
+    def to_ass(self) -> str:
+        """将弹幕转换为从右向左滚动的ASS字幕脚本，供libass渲染
+
+        轨道分配使用独立的局部状态，不影响正在进行的渲染
+        """
+        enter_at = [float("-inf")] * len(self.track_heights)
+        leave_at = [float("-inf")] * len(self.track_heights)
+        family = self.font.getname()[0]
+        lines = [
+            "[Script Info]",
+            "ScriptType: v4.00+",
+            f"PlayResX: {self.video_width}",
+            f"PlayResY: {self.video_height}",
+            "",
+            "[V4+ Styles]",
+            "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, "
+            "OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, "
+            "ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+            "Alignment, MarginL, MarginR, MarginV, Encoding",
+            f"Style: Default,{family},25,&H00FFFFFF,&H00FFFFFF,&H00000000,"
+            "&H00000000,0,0,0,0,100,100,0,0,1,0,0,7,0,0,0,1",
+            "",
+            "[Events]",
+            "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, "
+            "Effect, Text",
         ]
-        self.active_danmakus.extend(new_danmakus)
+        for danmaku in sorted(self.danmakus, key=lambda d: d.time_stamp):
+            # 与render_frame一致: 8秒内从右边缘移动到完全移出左边缘
+            speed = self._speed(danmaku)
+            y = self._allocate_track(danmaku, speed, enter_at, leave_at)
+            r, g, b = danmaku.color
+            start = _format_ass_time(danmaku.time_stamp)
+            end = _format_ass_time(danmaku.time_stamp + 8)
+            tags = (
+                f"\\move({self.video_width},{y},{-int(np.ceil(danmaku.width))},{y})"
+                f"\\1c&H{b:02X}{g:02X}{r:02X}&\\1a&H{255 - danmaku.alpha:02X}&"
+            )
+            text = _escape_ass_text(danmaku.text)
+            lines.append(f"Dialogue: 0,{start},{end},Default,,0,0,0,,{{{tags}}}{text}")
+        return "\n".join(lines) + "\n"
 
-    def _get_available_track(self) -> int:
+    def _get_available_track(self, danmaku: Danmaku) -> int:
         """获取可用的弹幕轨道"""
+        return self._allocate_track(
+            danmaku, danmaku.speed, self._track_enter_at, self._track_leave_at
+        )
+
+    def _allocate_track(
+        self,
+        danmaku: Danmaku,
+        speed: float,
+        enter_at: List[float],
+        leave_at: List[float],
+    ) -> int:
+        """按给定的轨道状态为弹幕分配轨道，并更新该状态
+
+        选择编号最小的空闲轨道：该轨道上一条弹幕的尾部已完全进入画面，
+        并且新弹幕的头部到达左边缘之前上一条弹幕已经离开画面(不会追尾)。
+        没有空闲轨道时选择最早空出的轨道。
+        """
         if not self.track_heights:
             return 0
-        # 简单起见，这里随机选择一个轨道
-        return self.track_heights[int(time.time() * 1000) % len(self.track_heights)]
+        start = danmaku.time_stamp
+        reach_left_at = start + self.video_width / speed
+        for i in range(len(self.track_heights)):
+            if enter_at[i] <= start and leave_at[i] <= reach_left_at:
+                break
+        else:
+            i = min(range(len(self.track_heights)), key=enter_at.__getitem__)
+        enter_at[i] = start + (danmaku.width + self.track_gap) / speed
+        leave_at[i] = start + (self.video_width + danmaku.width) / speed
+        return self.track_heights[i]
+
+
+def _escape_ass_text(text: str) -> str:
+    """转义ASS文本中的特殊字符，使其按原样显示"""
+    # 反斜杠后插入零宽空格，避免与后续字符组成\N、\h等转义序列
+    text = text.replace("\\", "\\\u200b")
+    text = text.replace("{", "\\{").replace("}", "\\}")
+    return text.replace("\n", "\\N")
+
+
+def _format_ass_time(seconds: float) -> str:
+    """将秒数格式化为ASS时间格式 H:MM:SS.cc"""
+    cs = int(round(seconds * 100))
+    h, cs = divmod(cs, 360000)
+    m, cs = divmod(cs, 6000)
+    s, cs = divmod(cs, 100)
+    return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
+
+
+# 候选硬件解码设备，按优先级排列
+_HW_DECODE_DEVICES = ["cuda", "videotoolbox", "vaapi", "d3d11va"]
+
+
+def _open_av_container(input_video: str):
+    """用PyAV打开输入视频，优先使用可用的硬件解码设备"""
+    try:
+        from av.codec.hwaccel import HWAccel, hwdevices_available
+    except ImportError:  # 较旧的PyAV不支持硬件解码
+        return av.open(input_video)
+
+    available = hwdevices_available()
+    for device_type in _HW_DECODE_DEVICES:
+        if device_type not in available:
+            continue
+        try:
+            return av.open(
+                input_video,
+                hwaccel=HWAccel(device_type=device_type, allow_software_fallback=True),
+            )
+        except av.FFmpegError:
+            continue
+    return av.open(input_video)
+
+
+class PyAVReader:
+    """通过PyAV(FFmpeg)解码视频，可用时使用硬件解码，接口与cv2.VideoCapture一致"""
+
+    def __init__(self, input_video: str):
+        self.input_video = input_video
+        self._open()
+        self._skip_until = None  # 跳转后丢弃时间早于该值的帧
+
+    def _open(self):
+        """打开输入视频，从头开始解码"""
+        self.container = _open_av_container(self.input_video)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        self._frames = self.container.decode(self.stream)
+
+    def get(self, prop_id: int) -> float:
+        """读取视频属性，支持宽、高、帧率和总帧数"""
+        codec_context = self.stream.codec_context
+        fps = float(self.stream.average_rate or 0)
+        if prop_id == cv2.CAP_PROP_FRAME_WIDTH:
+            return codec_context.width
+        if prop_id == cv2.CAP_PROP_FRAME_HEIGHT:
+            return codec_context.height
+        if prop_id == cv2.CAP_PROP_FPS:
+            return fps
+        if prop_id == cv2.CAP_PROP_FRAME_COUNT:
+            if self.stream.frames:
+                return self.stream.frames
+            # 部分容器不记录帧数，按时长估算
+            if self.container.duration is not None:
+                return int(self.container.duration / av.time_base * fps)
+        return 0
+
+    def set(self, prop_id: int, value: float) -> bool:
+        """跳转到指定帧，仅支持CAP_PROP_POS_FRAMES"""
+        if prop_id != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        fps = self.get(cv2.CAP_PROP_FPS)
+        # 先跳到目标之前的关键帧，再逐帧解码丢弃到目标帧
+        target = value / fps
+        self._skip_until = target - 0.5 / fps
+        start_time = self.stream.start_time or 0
+        back = 0.0
+        while True:
+            seek_to = max(target - back, 0.0)
+            self.container.seek(
+                int(seek_to / self.stream.time_base) + start_time,
+                backward=True,
+                stream=self.stream,
+            )
+            self._frames = self.container.decode(self.stream)
+            first = next(self._frames, None)
+            # 落在目标帧(含恰好是关键帧的情况)或之前都可以，之后逐帧丢弃到目标
+            if first is not None and self._frame_time(first) <= target + 0.5 / fps:
+                self._frames = chain([first], self._frames)
+                return True
+            if seek_to == 0:
+                break
+            # 部分容器(如MPEG-TS)的跳转不精确，落点越过目标时逐步多退一些重试
+            back = max(1.0, back * 2)
+
+        # 退到起点仍越过目标，重新打开视频从头解码
+        self.container.close()
+        self._open()
+        return True
+
+    def _frame_time(self, frame) -> float:
+        """帧相对于视频流起点的时间(秒)"""
+        if frame.pts is None:
+            return float("inf")
+        return float(
+            (frame.pts - (self.stream.start_time or 0)) * self.stream.time_base
+        )
+
+    def read(self, image: Optional[np.ndarray] = None) -> Tuple[bool, np.ndarray]:
+        """读取下一帧BGR图像；解码结果直接返回，不复制到image中"""
+        while True:
+            frame = next(self._frames, None)
+            if frame is None:
+                return False, None
+            if self._skip_until is not None:
+                if self._frame_time(frame) < self._skip_until:
+                    continue
+                self._skip_until = None
+            return True, frame.to_ndarray(format="bgr24")
+
+    def release(self):
+        """关闭输入视频"""
+        self.container.close()
+
+
+# 候选H.264编码器，按优先级排列: (编码器, 输入前参数, 输出参数)
+_H264_ENCODERS = [
+    ("h264_nvenc", [], ["-preset", "p5", "-pix_fmt", "yuv420p"]),
+    ("h264_videotoolbox", [], ["-pix_fmt", "yuv420p"]),
+    (
+        "h264_vaapi",
+        ["-vaapi_device", "/dev/dri/renderD128"],
+        ["-vf", "format=nv12,hwupload"],
+    ),
+    ("libx264", [], ["-preset", "veryfast", "-pix_fmt", "yuv420p"]),
+]
+
+
+# yuv420p要求宽高为偶数，奇数尺寸时在右侧和底部补一像素
+_PAD_TO_EVEN = "pad=ceil(iw/2)*2:ceil(ih/2)*2"
+
+
+def _with_filters(filters: List[str], output_args: Tuple[str, ...]) -> List[str]:
+    """将滤镜与编码器自带的滤镜(如VAAPI的hwupload，需接在最后)合并为输出参数"""
+    output_args = list(output_args)
+    filters = list(filters)
+    if "-vf" in output_args:
+        i = output_args.index("-vf")
+        filters.append(output_args[i + 1])
+        del output_args[i : i + 2]
+    if filters:
+        output_args = ["-vf", ",".join(filters)] + output_args
+    return output_args
+
+
+# _initialize的encoder参数未给出时的占位值，None表示没有可用的ffmpeg
+_ENCODER_UNSET = object()
+
+
+@lru_cache(maxsize=None)
+def _select_h264_encoder() -> Optional[Tuple[str, Tuple[str, ...], Tuple[str, ...]]]:
+    """探测本机ffmpeg可用的H.264编码器，优先硬件编码，没有ffmpeg时返回None"""
+    if shutil.which("ffmpeg") is None:
+        return None
+    for name, input_args, output_args in _H264_ENCODERS:
+        # 实际编码几帧测试，仅出现在编码器列表中不代表有可用的硬件
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+            + input_args
+            + ["-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.1"]
+            + ["-c:v", name]
+            + output_args
+            + ["-f", "null", "-"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if result.returncode == 0:
+            return name, tuple(input_args), tuple(output_args)
+    return None
+
+
+class FFmpegWriter:
+    """通过管道将BGR原始帧交给ffmpeg编码，接口与cv2.VideoWriter一致"""
+
+    def __init__(
+        self,
+        output_video: str,
+        fps: float,
+        frame_size: Tuple[int, int],
+        encoder: Tuple[str, Tuple[str, ...], Tuple[str, ...]],
+    ):
+        name, input_args, output_args = encoder
+        width, height = frame_size
+        self.encoder = name
+        filters = [_PAD_TO_EVEN] if width % 2 or height % 2 else []
+        self.process = subprocess.Popen(
+            ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"]
+            + list(input_args)
+            + ["-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}"]
+            + ["-r", str(fps), "-i", "-", "-c:v", name]
+            + _with_filters(filters, output_args)
+            + [output_video],
+            stdin=subprocess.PIPE,
+        )
+
+    def write(self, frame: np.ndarray):
+        """写入一帧"""
+        # 直接写入数组内存，避免tobytes()复制整帧
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        """结束输入并等待ffmpeg完成编码"""
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {self.process.returncode}")
 
 
 class VideoProcessor:
     """视频处理器类"""
 
-    def __init__(self, input_video: str, output_video: str, danmaku_file: str):
+    def __init__(
+        self,
+        input_video: str,
+        output_video: str,
+        danmaku_file: str,
+        use_cuda: bool = False,
+    ):
+        # 在打开输入、启动编码器之前检查，避免留下空的输出文件
+        if use_cuda and cp is None:
+            raise RuntimeError("CuPy is required to render danmaku on the GPU")
         self.input_video = input_video
         self.output_video = output_video
         self.danmaku_file = danmaku_file
+        self.use_cuda = use_cuda  # 是否使用CuPy在GPU上合成弹幕
         self.danmaku_list = self.parse_danmaku_file(danmaku_file)
         self.cap = None
         self.out = None
@@ -146,25 +664,32 @@ class VideoProcessor:
     ) -> List[Tuple[str, float, Tuple[int, int, int], int]]:
         """解析弹幕文件，支持ASS、SSA和JSON格式"""
         if file_path.endswith(".json"):
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return [
-                    (
-                        item["text"],
-                        float(item["time_stamp"]),
-                        tuple(item["color"]),
-                        item["alpha"],
-                    )
-                    for item in data
-                ]
+            if orjson is not None:
+                with open(file_path, "rb") as f:
+                    data = orjson.loads(f.read())
+            else:
+                with open(file_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            return [
+                (
+                    item["text"],
+                    float(item["time_stamp"]),
+                    tuple(item["color"]),
+                    item["alpha"],
+                )
+                for item in data
+            ]
         elif file_path.endswith(".ass") or file_path.endswith(".ssa"):
             danmakus = []
             with open(file_path, "r", encoding="utf-8") as f:
                 for line in f:
                     if line.startswith("Dialogue:"):
-                        parts = line.split(",")
+                        # 只切分出前9个字段，文本中的逗号保持原样
+                        parts = line.split(",", 9)
+                        if len(parts) < 10:
+                            continue  # 字段不全的行无法取得文本，跳过
                         start_time = self.parse_ass_time(parts[1])
-                        text = parts[-1].strip()
+                        text = parts[9].strip()
                         color = (255, 255, 255)  # 默认白色
                         alpha = 255  # 默认不透明
                         danmakus.append((text, start_time, color, alpha))
@@ -173,55 +698,319 @@ class VideoProcessor:
             raise ValueError("Unsupported file format")
 
     def parse_ass_time(self, time_str: str) -> float:
-        """解析ASS/SSA时间格式"""
-        h, m, s, cs = map(float, re.split("[:.]", time_str))
-        return h * 3600 + m * 60 + s + cs / 100
+        """解析ASS/SSA时间格式 H:MM:SS.cc"""
+        # 分、秒、厘秒位置固定，从末尾按偏移切片，小时可以是任意位数
+        time_str = time_str.strip()
+        h = int(time_str[:-9])
+        m = int(time_str[-8:-6])
+        s = int(time_str[-5:-3])
+        cs = int(time_str[-2:])
+        return (h * 360000 + m * 6000 + s * 100 + cs) / 100
 
-    def _initialize(self):
-        """初始化视频处理器"""
-        self.cap = cv2.VideoCapture(self.input_video)
+    def _initialize(self, encoder=_ENCODER_UNSET):
+        """初始化视频处理器，encoder为已探测好的H.264编码器，默认在此探测"""
+        # 安装了PyAV时用其解码(可用时为硬件解码)，否则使用OpenCV
+        if av is not None:
+            self.cap = PyAVReader(self.input_video)
+        else:
+            self.cap = cv2.VideoCapture(self.input_video)
         self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.fps = int(self.cap.get(cv2.CAP_PROP_FPS))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
         self.total_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
-        # 创建视频写入器
-        fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-        self.out = cv2.VideoWriter(
-            self.output_video, fourcc, self.fps, (self.width, self.height)
-        )
+        # 创建视频写入器，优先使用ffmpeg硬件编码，没有ffmpeg时回退到OpenCV
+        if encoder is _ENCODER_UNSET:
+            encoder = _select_h264_encoder()
+        if encoder is not None:
+            self.out = FFmpegWriter(
+                self.output_video, self.fps, (self.width, self.height), encoder
+            )
+        else:
+            fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+            self.out = cv2.VideoWriter(
+                self.output_video, fourcc, self.fps, (self.width, self.height)
+            )
 
         # 初始化弹幕管理器
-        self.manager = DanmakuManager(self.width, self.height)
+        self.manager = self._create_manager(
+            self.width, self.height, self.fps, use_cuda=self.use_cuda
+        )
+
+    def _create_manager(
+        self, width: int, height: int, fps: float = 30, use_cuda: bool = False
+    ) -> DanmakuManager:
+        """创建弹幕管理器并载入解析好的弹幕"""
+        manager = DanmakuManager(width, height, fps=fps, use_cuda=use_cuda)
         for item in self.danmaku_list:
             if len(item) == 2:  # 只有文本和时间戳
-                self.manager.add_danmaku(*item)
+                manager.add_danmaku(*item)
             elif len(item) == 3:  # 包含颜色
-                self.manager.add_danmaku(*item)
+                manager.add_danmaku(*item)
             elif len(item) == 4:  # 包含颜色和透明度
-                self.manager.add_danmaku(*item)
+                manager.add_danmaku(*item)
+        return manager
 
     def process(self):
         """处理视频"""
         try:
             self._initialize()
+            self._run_pipeline()
+            typer.echo("✨ Processing completed successfully!")
 
-            with typer.progressbar(
-                range(self.total_frames), label="Processing video"
-            ) as progress:
-                for _ in progress:
-                    ret, frame = self.cap.read()
-                    if not ret:
+        finally:
+            self.cleanup()
+
+    def process_parallel(self, n_workers: Optional[int] = None):
+        """按帧区间将视频切分为多段，多进程并行渲染后用ffmpeg拼接(需要ffmpeg)
+
+        子进程以spawn方式启动，在脚本中调用时需放在 if __name__ == "__main__" 之下
+        """
+        # 只在主进程探测一次编码器，子进程直接使用
+        encoder = _select_h264_encoder()
+        if encoder is None:
+            raise RuntimeError("ffmpeg is required to render danmaku in parallel")
+        n_workers = n_workers or os.cpu_count() or 1
+        cap = cv2.VideoCapture(self.input_video)
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        chunks = _split_frames(total_frames, n_workers)
+        if not chunks:
+            # 没有可切分的帧，交给单进程处理
+            self.process()
+            return
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            chunk_videos = [
+                os.path.join(tmp_dir, f"chunk_{i}.mp4") for i in range(len(chunks))
+            ]
+            # 使用spawn启动子进程：fork会复制已初始化的Numba(TBB)线程池，导致退出时挂起
+            with ProcessPoolExecutor(
+                max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        _render_chunk,
+                        self.input_video,
+                        chunk_video,
+                        self.danmaku_file,
+                        start,
+                        end,
+                        self.use_cuda,
+                        encoder,
+                    )
+                    for chunk_video, (start, end) in zip(chunk_videos, chunks)
+                ]
+                with typer.progressbar(
+                    length=len(futures), label="Processing video"
+                ) as progress:
+                    for future in as_completed(futures):
+                        future.result()
+                        progress.update(1)
+
+            # 用ffmpeg的concat demuxer无损拼接各段
+            list_file = os.path.join(tmp_dir, "chunks.txt")
+            with open(list_file, "w", encoding="utf-8") as f:
+                for chunk_video in chunk_videos:
+                    f.write(f"file '{chunk_video}'\n")
+            subprocess.run(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-loglevel",
+                    "error",
+                    "-f",
+                    "concat",
+                    "-safe",
+                    "0",
+                    "-i",
+                    list_file,
+                    "-c",
+                    "copy",
+                    self.output_video,
+                ],
+                check=True,
+            )
+
+        typer.echo("✨ Processing completed successfully!")
+
+    def process_libass(self):
+        """用ffmpeg的subtitles滤镜(libass)直接烧录弹幕，需要ffmpeg
+
+        ASS/SSA文件按其自身样式渲染；JSON弹幕先转换为滚动效果的ASS脚本
+        """
+        encoder = _select_h264_encoder()
+        if encoder is None:
+            raise RuntimeError("ffmpeg is required to render danmaku with libass")
+        name, input_args, output_args = encoder
+        subtitles = "subtitles=danmaku.ass"
+
+        # 在临时目录中使用固定文件名，避免在滤镜参数中转义路径
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            subtitle_file = os.path.join(tmp_dir, "danmaku.ass")
+            if self.danmaku_file.endswith((".ass", ".ssa")):
+                shutil.copyfile(self.danmaku_file, subtitle_file)
+            else:
+                cap = cv2.VideoCapture(self.input_video)
+                width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                cap.release()
+                manager = self._create_manager(width, height)
+                with open(subtitle_file, "w", encoding="utf-8") as f:
+                    f.write(manager.to_ass())
+                # 脚本按字体族名引用字体，按路径载入的字体libass未必能找到，
+                # 复制到临时目录并通过fontsdir提供给libass
+                if os.path.isfile(manager.font_path):
+                    fonts_dir = os.path.join(tmp_dir, "fonts")
+                    os.mkdir(fonts_dir)
+                    shutil.copy(manager.font_path, fonts_dir)
+                    subtitles += ":fontsdir=fonts"
+            output_args = _with_filters([subtitles, _PAD_TO_EVEN], output_args)
+
+            subprocess.run(
+                ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"]
+                + list(input_args)
+                + ["-i", os.path.abspath(self.input_video)]
+                + ["-c:v", name]
+                + output_args
+                + ["-c:a", "copy", os.path.abspath(self.output_video)],
+                cwd=tmp_dir,
+                check=True,
+            )
+
+        typer.echo("✨ Processing completed successfully!")
+
+    def _run_pipeline(
+        self, start: int = 0, end: Optional[int] = None, show_progress: bool = True
+    ):
+        """解码、渲染、编码三级流水线：解码和编码各占一个线程，主线程渲染
+
+        只处理[start, end)区间内的帧，之前的帧只推进弹幕状态而不渲染
+        """
+        end = self.total_frames if end is None else end
+        if start > 0:
+            if isinstance(self.cap, PyAVReader):
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+            else:
+                # OpenCV在部分容器(如MPEG-TS)上跳转会落到错误的帧且不报错，
+                # 只能逐帧解码丢弃到起始帧
+                for _ in range(start):
+                    if not self.cap.grab():
                         break
+            for frame_idx in range(start):
+                self.manager.advance(frame_idx / self.fps)
+
+        decoded_q = queue.Queue(maxsize=8)
+        rendered_q = queue.Queue(maxsize=8)
+        # 预分配帧缓冲池，解码直接写入缓冲，编码后归还，循环使用以避免逐帧分配
+        # 数量足够填满两个队列，另外解码、渲染、编码各持有一个
+        free_q = queue.Queue()
+        for _ in range(decoded_q.maxsize + rendered_q.maxsize + 3):
+            free_q.put(np.empty((self.height, self.width, 3), dtype=np.uint8))
+        stop = threading.Event()
+        errors = []
+        threads = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(
+                    partial(self._read_frames, free_q=free_q, start=start, end=end),
+                    decoded_q,
+                    stop,
+                    errors,
+                ),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self._run_stage,
+                args=(
+                    partial(self._write_frames, free_q=free_q),
+                    rendered_q,
+                    stop,
+                    errors,
+                ),
+                daemon=True,
+            ),
+        ]
+        for thread in threads:
+            thread.start()
 
-                    current_time = self.cap.get(cv2.CAP_PROP_POS_FRAMES) / self.fps
+        try:
+            # 帧序号由解码线程计数，无需逐帧查询CAP_PROP_POS_FRAMES；
+            # 进度条约每1%刷新一次，避免逐帧写终端
+            if show_progress:
+                progress_bar = typer.progressbar(
+                    length=end - start,
+                    label="Processing video",
+                    update_min_steps=max(1, (end - start) // 100),
+                )
+            else:
+                progress_bar = nullcontext()
+            with progress_bar as progress:
+                while True:
+                    item = _queue_get(decoded_q, stop)
+                    if item is None:
+                        break
+                    frame_idx, frame = item
+                    current_time = frame_idx / self.fps
                     frame_with_danmaku = self.manager.render_frame(frame, current_time)
-                    self.out.write(frame_with_danmaku)
+                    if not _queue_put(rendered_q, frame_with_danmaku, stop):
+                        break
+                    if progress is not None:
+                        progress.update(1)
+            _queue_put(rendered_q, None, stop)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
 
-            typer.echo("✨ Processing completed successfully!")
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _run_stage(target, q: queue.Queue, stop: threading.Event, errors: list):
+        """运行流水线的一级，出错时记录异常并中止整条流水线"""
+        try:
+            target(q, stop)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
 
+    def _read_frames(
+        self,
+        decoded_q: queue.Queue,
+        stop: threading.Event,
+        free_q: queue.Queue,
+        start: int,
+        end: int,
+    ):
+        """解码线程：逐帧读取视频到空闲缓冲中，连同帧序号放入队列"""
+        frame_idx = start
+        try:
+            while frame_idx < end:
+                buffer = _queue_get(free_q, stop)
+                if buffer is None:
+                    break
+                ret, frame = self.cap.read(buffer)
+                if not ret:
+                    break
+                if not _queue_put(decoded_q, (frame_idx, frame), stop):
+                    break
+                frame_idx += 1
         finally:
-            self.cleanup()
+            _queue_put(decoded_q, None, stop)
+
+    def _write_frames(
+        self, rendered_q: queue.Queue, stop: threading.Event, free_q: queue.Queue
+    ):
+        """编码线程：从队列取出渲染好的帧写入输出视频，之后归还缓冲"""
+        while True:
+            frame = _queue_get(rendered_q, stop)
+            if frame is None:
+                break
+            self.out.write(frame)
+            free_q.put(frame)
 
     def cleanup(self):
         """清理资源"""
@@ -229,3 +1018,30 @@ class VideoProcessor:
             self.cap.release()
         if self.out is not None:
             self.out.release()
+
+
+def _split_frames(total_frames: int, n_chunks: int) -> List[Tuple[int, int]]:
+    """将[0, total_frames)尽量均匀地切分为至多n_chunks个非空的连续区间"""
+    n_chunks = min(n_chunks, total_frames)
+    if n_chunks <= 0:
+        return []
+    bounds = [total_frames * i // n_chunks for i in range(n_chunks + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _render_chunk(
+    input_video: str,
+    output_video: str,
+    danmaku_file: str,
+    start: int,
+    end: int,
+    use_cuda: bool = False,
+    encoder: Optional[Tuple[str, Tuple[str, ...], Tuple[str, ...]]] = None,
+):
+    """子进程入口：渲染[start, end)区间的帧到单独的视频文件"""
+    processor = VideoProcessor(input_video, output_video, danmaku_file, use_cuda)
+    try:
+        processor._initialize(encoder)
+        processor._run_pipeline(start, end, show_progress=False)
+    finally:
+        processor.cleanup()